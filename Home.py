@@ -5,9 +5,11 @@ import numpy as np
 import pandas as pd
 import json
 import base64
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import httpx
 from PIL import Image, ImageOps
 from dotenv import load_dotenv
-from openai import AzureOpenAI
+from openai import APIError, AzureOpenAI
 import io
 import database
 
@@ -17,36 +19,113 @@ load_dotenv()
 # Initialize Database
 database.init_db()
 
+# Use OpenCV's SIMD-optimized code paths for preprocessing. Images are already cleaned in
+# parallel by the thread pool below, so each call runs single-threaded to avoid oversubscribing
+cv2.setUseOptimized(True)
+cv2.setNumThreads(1)
+
+# Retries per request on 429s and transient errors; the SDK backs off and honors Retry-After
+MAX_RETRIES = 3
+
 # Initialize Azure OpenAI Client
-client = AzureOpenAI(
-    azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-    api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-    api_version="2024-12-01-preview"
-)
+@st.cache_resource
+def get_client():
+    """
+    Returns an Azure OpenAI client shared across reruns, backed by a pooled HTTP/2 connection.
+    """
+    http_client = httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=20, keepalive_expiry=60),
+        # Multi-image extractions can take minutes; only connecting should fail fast
+        timeout=httpx.Timeout(600.0, connect=10.0)
+    )
+    return AzureOpenAI(
+        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+        api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+        api_version="2024-12-01-preview",
+        http_client=http_client,
+        max_retries=MAX_RETRIES
+    )
+
+client = get_client()
+
+# Number of images sent to the model per request
+BATCH_SIZE = 4
+
+# Longest side, in pixels, of the image sent to the model
+MAX_IMAGE_SIDE = 1500
+
+# Concurrent requests to Azure OpenAI; tune to the deployment's rate-limit tier
+MAX_WORKERS = int(os.getenv("AZURE_OPENAI_MAX_WORKERS", "10"))
+
+# Uploads larger than this get a hint to use the asynchronous Batch API
+BATCH_API_THRESHOLD = 20
+
+# EXIF tag holding the camera orientation (1 = upright)
+EXIF_ORIENTATION_TAG = 274
 
-def clean_image(uploaded_file):
+def apply_exif_orientation(img, orientation):
+    """
+    Applies an EXIF orientation to an OpenCV image, matching Pillow's ImageOps.exif_transpose.
+    """
+    if orientation == 2:
+        return cv2.flip(img, 1)
+    if orientation == 3:
+        return cv2.rotate(img, cv2.ROTATE_180)
+    if orientation == 4:
+        return cv2.flip(img, 0)
+    if orientation == 5:
+        return cv2.transpose(img)
+    if orientation == 6:
+        return cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE)
+    if orientation == 7:
+        return cv2.flip(cv2.transpose(img), -1)
+    if orientation == 8:
+        return cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE)
+    return img
+
+@st.cache_data(show_spinner=False)
+def clean_image(file_bytes):
     """
     Pre-processes the image for better OCR/AI extraction.
+    Cached on the raw file bytes, so re-processing the same photo is free.
     """
-    # Step A: Open with Pillow and fix rotation
-    image = Image.open(uploaded_file)
-    image = ImageOps.exif_transpose(image)
+    # Step A: Decode straight to grayscale with OpenCV
+    # EXIF orientation is applied separately below, so OpenCV must not apply it too
+    gray = cv2.imdecode(
+        np.frombuffer(file_bytes, np.uint8),
+        cv2.IMREAD_GRAYSCALE | cv2.IMREAD_IGNORE_ORIENTATION
+    )
 
-    # Step B: Convert to Numpy array for OpenCV
-    img_array = np.array(image)
+    if gray is not None:
+        # Step B: Fix rotation using only the EXIF orientation tag
+        orientation = Image.open(io.BytesIO(file_bytes)).getexif().get(EXIF_ORIENTATION_TAG, 1)
+        gray = apply_exif_orientation(gray, orientation)
+    else:
+        # Step B (fallback): Formats OpenCV can't decode go through Pillow
+        image = Image.open(io.BytesIO(file_bytes))
+        image = ImageOps.exif_transpose(image)
+        img_array = np.array(image)
 
-    # Step C: Convert to Grayscale
-    # Check if image has 3 channels (RGB) or 4 (RGBA) and convert accordingly
-    if len(img_array.shape) == 3:
-        if img_array.shape[2] == 4:
-            gray = cv2.cvtColor(img_array, cv2.COLOR_RGBA2GRAY)
+        # Step C: Convert to Grayscale
+        # Check if image has 3 channels (RGB) or 4 (RGBA) and convert accordingly
+        if len(img_array.shape) == 3:
+            if img_array.shape[2] == 4:
+                gray = cv2.cvtColor(img_array, cv2.COLOR_RGBA2GRAY)
+            else:
+                gray = cv2.cvtColor(img_array, cv2.COLOR_RGB2GRAY)
         else:
-            gray = cv2.cvtColor(img_array, cv2.COLOR_RGB2GRAY)
-    else:
-        # Already grayscale or single channel
-        gray = img_array
+            # Already grayscale or single channel
+            gray = img_array
+
+    # Step D: Downscale so the long side is at most MAX_IMAGE_SIDE pixels
+    # Fewer pixels means a smaller upload and fewer image tokens
+    h, w = gray.shape[:2]
+    scale = MAX_IMAGE_SIDE / max(h, w)
+    if scale < 1:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
 
-    # Step D: Apply Adaptive Thresholding
+    # Step E: Apply Adaptive Thresholding
     # Remove shadows/lighting issues
     processed_img = cv2.adaptiveThreshold(
         gray,
@@ -57,103 +136,189 @@ def clean_image(uploaded_file):
         2
     )
 
-    # Step E: Return the processed image encoded as base64 strings
-    # Encode processed image to buffer
-    is_success, buffer = cv2.imencode(".jpg", processed_img)
+    # Step F: Return the processed image encoded as base64 strings
+    # PNG is lossless and far smaller than JPEG on black-and-white output
+    is_success, buffer = cv2.imencode(".png", processed_img, [cv2.IMWRITE_PNG_COMPRESSION, 9])
     if not is_success:
         raise ValueError("Could not encode processed image")
 
     base64_image = base64.b64encode(buffer).decode("utf-8")
     return base64_image
 
-def extract_transactions(base64_image):
+def build_messages(base64_images):
     """
-    Sends the image to Azure OpenAI to extract transaction data.
+    Builds the chat messages asking the model to extract transactions from a list of images.
     """
-    deployment_name = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME")
-
-    response = client.chat.completions.create(
-        model=deployment_name,
-        messages=[
-            {
-                "role": "system",
-                "content": "You are a data entry assistant. Extract bank transactions from this image. Return ONLY raw JSON. The format must be a list of objects: [{'date': 'YYYY-MM-DD', 'description': '...', 'withdrawal': float, 'deposit': float, 'balance': float}]. Return 0 for empty numeric fields."
-            },
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{base64_image}"
-                        }
-                    }
-                ]
+    content = [
+        {
+            "type": "text",
+            "text": f"Return a JSON array of arrays, one per image in order ({len(base64_images)} images)."
+        }
+    ]
+    content += [
+        {
+            "type": "image_url",
+            "image_url": {
+                "url": f"data:image/png;base64,{base64_image}"
             }
-        ],
-        max_tokens=4096
-    )
+        }
+        for base64_image in base64_images
+    ]
 
-    content = response.choices[0].message.content
+    return [
+        {
+            "role": "system",
+            "content": "You are a data entry assistant. Extract bank transactions from each image. Return ONLY raw JSON. The format must be a list with one entry per image, in the order given, where each entry is a list of objects: [[{'date': 'YYYY-MM-DD', 'description': '...', 'withdrawal': float, 'deposit': float, 'balance': float}]]. Return an empty list for an image with no transactions and 0 for empty numeric fields."
+        },
+        {
+            "role": "user",
+            "content": content
+        }
+    ]
 
-    # Clean up markdown code blocks if present
+def strip_code_fences(content):
+    """
+    Removes markdown code blocks wrapped around the model's JSON output.
+    """
     if content.startswith("```json"):
         content = content.replace("```json", "").replace("```", "")
     elif content.startswith("```"):
         content = content.replace("```", "")
-
     return content
 
-# UI Setup
-st.set_page_config(page_title="Bank Statement AI Digitizer", layout="wide")
-st.title("Bank Statement AI Digitizer")
+class ExtractionError(ValueError):
+    """
+    Raised when the model's output can't be used. Keeps the raw output for display.
+    """
+    def __init__(self, message, raw_output):
+        super().__init__(message)
+        self.raw_output = raw_output
 
-uploaded_files = st.file_uploader("Upload Bank Statement Photos", type=["jpg", "png", "jpeg"], accept_multiple_files=True)
+@st.cache_data(show_spinner=False)
+def extract_transactions(base64_images, deployment_name):
+    """
+    Sends a batch of images to Azure OpenAI in a single request to extract transaction data.
+    Returns the parsed response: one list of transactions per image, in upload order.
+    Cached on the images and deployment; temperature 0 keeps repeated calls consistent.
+    Unusable output raises instead of returning, since exceptions are not cached.
+    """
+    response = client.chat.completions.create(
+        model=deployment_name,
+        messages=build_messages(base64_images),
+        max_tokens=4096 * len(base64_images),
+        temperature=0
+    )
 
-if st.button("Process") and uploaded_files:
-    all_transactions = []
-    progress_bar = st.progress(0)
-    status_text = st.empty()
+    raw_output = response.choices[0].message.content
+    try:
+        data = json.loads(strip_code_fences(raw_output))
+    except json.JSONDecodeError as e:
+        raise ExtractionError("Failed to parse JSON", raw_output) from e
+    if not isinstance(data, list) or len(data) != len(base64_images):
+        raise ExtractionError(f"Expected a list of {len(base64_images)} results from the model", raw_output)
+    return data
 
-    for i, uploaded_file in enumerate(uploaded_files):
-        status_text.text(f"Processing file {i+1} of {len(uploaded_files)}: {uploaded_file.name}...")
+def tag_transactions(names, data):
+    """
+    Flattens per-image results into one list, tagging each record with its source file.
+    """
+    transactions = []
+    for name, records in zip(names, data):
+        for record in records:
+            record['source_file'] = name
+        transactions.extend(records)
+    return transactions
 
-        try:
-            # 1. Pre-process
-            base64_img = clean_image(uploaded_file)
+def parse_transactions(names, json_response):
+    """
+    Parses the model output for the given files and tags each record with its source file.
+    Reports problems in the UI and returns an empty list if the output is unusable.
+    """
+    try:
+        data = json.loads(json_response)
+    except json.JSONDecodeError:
+        st.error(f"Failed to parse JSON for {', '.join(names)}")
+        st.text_area("Raw Output", json_response, height=200)
+        return []
 
-            # 2. Extract
-            json_response = extract_transactions(base64_img)
+    if len(data) != len(names):
+        st.error(f"Expected {len(names)} results but got {len(data)} for {', '.join(names)}")
+        st.text_area("Raw Output", json_response, height=200)
+        return []
 
-            # 3. Parse
-            try:
-                data = json.loads(json_response)
-                # Add source file name to each record
-                for record in data:
-                    record['source_file'] = uploaded_file.name
-                all_transactions.extend(data)
-            except json.JSONDecodeError:
-                st.error(f"Failed to parse JSON for {uploaded_file.name}")
-                st.text_area("Raw Output", json_response, height=200)
+    return tag_transactions(names, data)
 
-        except Exception as e:
-            st.error(f"Error processing {uploaded_file.name}: {str(e)}")
+def submit_batch_job(cleaned):
+    """
+    Submits one request per image to the Azure OpenAI Batch API and returns the batch id.
+    """
+    deployment_name = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME")
 
-        # Update progress
-        progress_bar.progress((i + 1) / len(uploaded_files))
+    lines = []
+    for i, (name, base64_img) in enumerate(cleaned):
+        lines.append(json.dumps({
+            "custom_id": f"{i}:{name}",
+            "method": "POST",
+            "url": "/chat/completions",
+            "body": {
+                "model": deployment_name,
+                "messages": build_messages([base64_img]),
+                "max_tokens": 4096,
+                "temperature": 0
+            }
+        }))
 
-    status_text.text("Processing complete!")
+    batch_file = client.files.create(
+        file=("transactions.jsonl", "\n".join(lines).encode("utf-8")),
+        purpose="batch"
+    )
+    batch = client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/chat/completions",
+        completion_window="24h"
+    )
+    return batch.id
 
+def collect_batch_results(batch):
+    """
+    Downloads the output of a completed batch job and parses it into transactions.
+    Requests that failed are listed in the error file and reported per image.
+    """
+    lines = []
+    # Either file is missing when every request succeeded or every request failed
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if file_id:
+            lines += client.files.content(file_id).text.splitlines()
+
+    results = []
+    for line in lines:
+        if not line.strip():
+            continue
+        result = json.loads(line)
+        index, name = result["custom_id"].split(":", 1)
+        response = result.get("response") or {}
+        if response.get("status_code") != 200:
+            st.error(f"Error processing {name}: {result.get('error') or response.get('body')}")
+            continue
+        json_response = strip_code_fences(response["body"]["choices"][0]["message"]["content"])
+        results.append((int(index), parse_transactions([name], json_response)))
+
+    # Output lines are not guaranteed to follow input order
+    all_transactions = []
+    for _, records in sorted(results, key=lambda r: r[0]):
+        all_transactions.extend(records)
+    return all_transactions
+
+def show_results(all_transactions, fallback_name):
+    """
+    Saves extracted transactions to the database and previews them.
+    """
     if all_transactions:
         df = pd.DataFrame(all_transactions)
 
         # Save to Database
-        # We pass the dataframe and a generic filename if it was a batch,
-        # but actually save_transactions handles the source_file column if present.
-        # We'll pass the first filename as a fallback if needed, but our logic in database.py
-        # uses the row's source_file.
-
-        saved_count = database.save_transactions(df, uploaded_files[0].name if uploaded_files else "unknown")
+        # save_transactions uses each row's source_file column; the filename is only a fallback.
+        saved_count = database.save_transactions(df, fallback_name)
 
         st.success(f"Processed {len(df)} transactions. Saved {saved_count} new records to database (duplicates ignored).")
         st.info("Go to the 'Classifier' page to view and categorize your data.")
@@ -163,3 +328,128 @@ if st.button("Process") and uploaded_files:
 
     else:
         st.warning("No transactions extracted.")
+
+def forget_batch_job():
+    """
+    Clears the pending batch job so it is no longer polled.
+    """
+    database.set_pending_batch_id(None)
+    st.session_state["batch_id"] = None
+
+def check_batch_job(batch_id):
+    """
+    Polls a submitted batch job and saves its results once it completes.
+    The job stays pending until its results are saved, so a failure can be retried.
+    """
+    try:
+        batch = client.batches.retrieve(batch_id)
+    except APIError as e:
+        # Transient API errors shouldn't break the page; try again on the next rerun
+        st.warning(f"Could not check batch job {batch_id}: {e}")
+        st.button("Refresh batch status")
+        return
+
+    if batch.status == "completed":
+        st.success(f"Batch job {batch.id} completed.")
+        try:
+            show_results(collect_batch_results(batch), "batch")
+        except Exception as e:
+            # Saving ignores duplicates, so collecting again is safe
+            st.error(f"Could not collect the results of batch job {batch.id}: {e}")
+            col_retry, col_discard = st.columns([1, 4])
+            col_retry.button("Retry")
+            col_discard.button("Discard batch job", on_click=forget_batch_job)
+        else:
+            forget_batch_job()
+    elif batch.status in ("failed", "expired", "cancelled"):
+        st.error(f"Batch job {batch.id} {batch.status}.")
+        forget_batch_job()
+    else:
+        st.info(f"Batch job {batch.id} is {batch.status}. Results are saved automatically once it completes.")
+        st.button("Refresh batch status")
+
+# UI Setup
+st.set_page_config(page_title="Bank Statement AI Digitizer", layout="wide")
+st.title("Bank Statement AI Digitizer")
+
+# Check on a previously submitted batch job
+if "batch_id" not in st.session_state:
+    st.session_state["batch_id"] = database.get_pending_batch_id()
+
+if st.session_state["batch_id"]:
+    check_batch_job(st.session_state["batch_id"])
+
+uploaded_files = st.file_uploader("Upload Bank Statement Photos", type=["jpg", "png", "jpeg"], accept_multiple_files=True)
+
+use_batch_api = st.toggle(
+    "Use batch API (cheaper, async)",
+    value=False,
+    help="Submit the images as an Azure OpenAI batch job. Results arrive within 24 hours at lower cost."
+)
+if len(uploaded_files) > BATCH_API_THRESHOLD and not use_batch_api:
+    st.caption(f"Tip: the batch API is recommended for more than {BATCH_API_THRESHOLD} files.")
+
+if st.button("Process") and uploaded_files:
+    all_transactions = []
+    progress_bar = st.progress(0)
+    status_text = st.empty()
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        # 1. Pre-process each file individually so one bad photo doesn't sink its batch
+        futures = [executor.submit(clean_image, uploaded_file.getvalue()) for uploaded_file in uploaded_files]
+        cleaned = []
+        for uploaded_file, future in zip(uploaded_files, futures):
+            try:
+                cleaned.append((uploaded_file.name, future.result()))
+            except Exception as e:
+                st.error(f"Error processing {uploaded_file.name}: {str(e)}")
+
+        if use_batch_api:
+            if st.session_state["batch_id"]:
+                st.error("A batch job is already pending. Wait for it to finish before submitting another.")
+            elif cleaned:
+                status_text.text(f"Submitting {len(cleaned)} files as a batch job...")
+                try:
+                    batch_id = submit_batch_job(cleaned)
+                    database.set_pending_batch_id(batch_id)
+                    st.session_state["batch_id"] = batch_id
+                    status_text.text(f"Submitted batch job {batch_id}.")
+                    st.info("Results will be saved when you revisit this page after the job completes.")
+                except Exception as e:
+                    st.error(f"Error submitting batch job: {str(e)}")
+            progress_bar.progress(1.0)
+            st.stop()
+
+        # 2. Extract in batches: one request per BATCH_SIZE images, dispatched concurrently
+        batches = [cleaned[i:i + BATCH_SIZE] for i in range(0, len(cleaned), BATCH_SIZE)]
+        deployment_name = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME")
+        futures = {
+            executor.submit(extract_transactions, [base64_img for _, base64_img in batch], deployment_name): i
+            for i, batch in enumerate(batches)
+        }
+        status_text.text(f"Extracting {len(cleaned)} files in {len(batches)} batches...")
+
+        results = [[] for _ in batches]
+        for done, future in enumerate(as_completed(futures), start=1):
+            i = futures[future]
+            names = [name for name, _ in batches[i]]
+
+            try:
+                # 3. Parse
+                results[i] = tag_transactions(names, future.result())
+            except ExtractionError as e:
+                st.error(f"Error processing {', '.join(names)}: {str(e)}")
+                st.text_area("Raw Output", e.raw_output, height=200, key=f"raw_output_{i}")
+            except Exception as e:
+                st.error(f"Error processing {', '.join(names)}: {str(e)}")
+
+            # Update progress
+            progress_bar.progress(done / len(batches))
+
+    # Keep upload order regardless of completion order
+    for records in results:
+        all_transactions.extend(records)
+
+    status_text.text("Processing complete!")
+
+    show_results(all_transactions, uploaded_files[0].name if uploaded_files else "unknown")
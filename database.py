@@ -1,76 +1,222 @@
 import sqlite3
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+import ahocorasick
+import numpy as np
 import pandas as pd
+import streamlit as st
 import os
 
 DB_NAME = "transactions.db"
 
+# Columns read back from the transactions table, in table order. Text stays
+# Arrow-backed instead of boxing every cell as a Python str
+TRANSACTION_DTYPES = {
+    'id': 'int64',
+    'date': 'string[pyarrow]',
+    'description': 'string[pyarrow]',
+    'amount': 'float64',
+    'category': 'string[pyarrow]',
+    'source_file': 'string[pyarrow]',
+    'project_name': 'string[pyarrow]',
+}
+
+# Ids bound per DELETE statement; well under SQLite's default parameter limit
+DELETE_CHUNK_SIZE = 500
+
+# Guards the shared connection: writers hold it for a whole transaction and readers
+# for their query, so no session ever reads another's uncommitted writes
+_conn_lock = threading.RLock()
+
+@st.cache_resource
 def get_connection():
-    return sqlite3.connect(DB_NAME)
+    """
+    Return the process-wide SQLite connection, shared across reruns and sessions.
+    """
+    conn = sqlite3.connect(DB_NAME, check_same_thread=False)
+    # Only takes effect on a brand-new database, before the first table is created
+    conn.execute("PRAGMA page_size=8192")
+    conn.execute("PRAGMA journal_mode=WAL")
+    # Per-connection settings: with WAL, NORMAL sync is still crash-safe
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-20000")
+    # Sample at most this many rows per index when PRAGMA optimize runs ANALYZE
+    conn.execute("PRAGMA analysis_limit=1000")
+    return conn
+
+@contextmanager
+def transaction():
+    """
+    Yield a cursor on the shared connection inside a single transaction.
+    Commits on success, rolls back on error, and keeps other threads from interleaving writes.
+    """
+    conn = get_connection()
+    with _conn_lock, conn:
+        cursor = conn.cursor()
+        # sqlite3 only opens a transaction implicitly before INSERT/UPDATE/DELETE/REPLACE;
+        # begin explicitly so DDL and WITH ... UPDATE statements are covered too
+        if not conn.in_transaction:
+            cursor.execute("BEGIN")
+        yield cursor
+        # Every committed write invalidates caches keyed on the database version
+        cursor.execute('''
+            INSERT INTO settings (key, value) VALUES ('db_version', 1)
+            ON CONFLICT(key) DO UPDATE SET value = value + 1
+        ''')
+
+@contextmanager
+def read_cursor():
+    """
+    Yield a cursor on the shared connection for reading.
+    Waits for any open transaction to finish, so only committed rows are seen.
+    """
+    with _conn_lock:
+        yield get_connection().cursor()
 
+def get_db_version():
+    """
+    Return a counter that changes whenever the database is written to.
+    Pass it to the cached readers below so they refresh only after a write.
+    """
+    with read_cursor() as cursor:
+        cursor.execute("SELECT value FROM settings WHERE key = 'db_version'")
+        row = cursor.fetchone()
+    if row:
+        return int(row[0])
+    return 0
+
+@st.cache_resource
 def init_db():
     """
     Initialize the database with the transactions, categories, and rules tables.
+    Runs once per process; later calls from page reruns return immediately.
     """
-    conn = get_connection()
-    cursor = conn.cursor()
-
-    # Transactions table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS transactions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            date TEXT,
-            description TEXT,
-            amount REAL,
-            category TEXT DEFAULT 'Uncategorized',
-            source_file TEXT,
-            project_name TEXT,
-            UNIQUE(date, description, amount, source_file)
-        )
-    ''')
-
-    # Migration: Add project_name if it doesn't exist
-    cursor.execute("PRAGMA table_info(transactions)")
-    columns = [info[1] for info in cursor.fetchall()]
-    if 'project_name' not in columns:
-        cursor.execute("ALTER TABLE transactions ADD COLUMN project_name TEXT")
-
-    # Categories table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS categories (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT UNIQUE
-        )
-    ''')
-
-    # Rules table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS rules (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            keyword TEXT UNIQUE,
-            category_name TEXT
-        )
-    ''')
-
-    # Settings table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS settings (
-            key TEXT PRIMARY KEY,
-            value TEXT
-        )
-    ''')
-
-    # Seed default categories if empty
-    cursor.execute("SELECT count(*) FROM categories")
-    if cursor.fetchone()[0] == 0:
-        defaults = [
-            "Uncategorized", "Revenue", "COGS", "OpEx", "Marketing",
-            "Salaries", "Rent", "Software", "Meals", "Travel",
-            "Personal", "Transfer", "Utilities", "Insurance", "Taxes"
-        ]
-        cursor.executemany("INSERT INTO categories (name) VALUES (?)", [(c,) for c in defaults])
-
-    conn.commit()
-    conn.close()
+    with transaction() as cursor:
+        # Transactions table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS transactions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                date TEXT,
+                description TEXT,
+                amount REAL,
+                category TEXT DEFAULT 'Uncategorized',
+                source_file TEXT,
+                project_name TEXT,
+                UNIQUE(date, description, amount, source_file)
+            )
+        ''')
+
+        # Migration: Add project_name if it doesn't exist
+        cursor.execute("PRAGMA table_info(transactions)")
+        columns = [info[1] for info in cursor.fetchall()]
+        if 'project_name' not in columns:
+            cursor.execute("ALTER TABLE transactions ADD COLUMN project_name TEXT")
+
+        # Indexes for auto-categorization lookups
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_tx_desc ON transactions(description)")
+        # Partial index: only the (small) uncategorized working set is indexed
+        cursor.execute("DROP INDEX IF EXISTS idx_tx_cat")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_tx_uncategorized ON transactions(category) WHERE category = 'Uncategorized'")
+
+        # Categories table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS categories (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT UNIQUE
+            )
+        ''')
+
+        # Rules table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS rules (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                keyword TEXT UNIQUE,
+                category_name TEXT
+            )
+        ''')
+
+        # Settings table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS settings (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        ''')
+
+        # Per-category running totals, kept current by triggers on transactions
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS category_totals (
+                category TEXT PRIMARY KEY,
+                sum_amount REAL NOT NULL DEFAULT 0,
+                tx_count INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        # Rebuild until the triggers exist. The rebuild and the triggers below commit together,
+        # so an interrupted init is redone on the next start
+        cursor.execute('''
+            SELECT COUNT(*) FROM sqlite_master
+            WHERE type = 'trigger' AND name IN ('trg_totals_insert', 'trg_totals_delete', 'trg_totals_update')
+        ''')
+        if cursor.fetchone()[0] < 3:
+            cursor.execute("DELETE FROM category_totals")
+            cursor.execute('''
+                INSERT INTO category_totals (category, sum_amount, tx_count)
+                SELECT category, TOTAL(amount), COUNT(*) FROM transactions GROUP BY category
+            ''')
+
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_totals_insert AFTER INSERT ON transactions
+            BEGIN
+                INSERT INTO category_totals (category, sum_amount, tx_count)
+                VALUES (NEW.category, IFNULL(NEW.amount, 0), 1)
+                ON CONFLICT(category) DO UPDATE SET
+                    sum_amount = sum_amount + excluded.sum_amount,
+                    tx_count = tx_count + 1;
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_totals_delete AFTER DELETE ON transactions
+            BEGIN
+                UPDATE category_totals
+                SET sum_amount = sum_amount - IFNULL(OLD.amount, 0), tx_count = tx_count - 1
+                WHERE category = OLD.category;
+                DELETE FROM category_totals WHERE category = OLD.category AND tx_count <= 0;
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_totals_update AFTER UPDATE OF category, amount ON transactions
+            BEGIN
+                UPDATE category_totals
+                SET sum_amount = sum_amount - IFNULL(OLD.amount, 0), tx_count = tx_count - 1
+                WHERE category = OLD.category;
+                DELETE FROM category_totals WHERE category = OLD.category AND tx_count <= 0;
+                INSERT INTO category_totals (category, sum_amount, tx_count)
+                VALUES (NEW.category, IFNULL(NEW.amount, 0), 1)
+                ON CONFLICT(category) DO UPDATE SET
+                    sum_amount = sum_amount + excluded.sum_amount,
+                    tx_count = tx_count + 1;
+            END
+        ''')
+
+        # Seed default categories if empty
+        cursor.execute("SELECT count(*) FROM categories")
+        if cursor.fetchone()[0] == 0:
+            defaults = [
+                "Uncategorized", "Revenue", "COGS", "OpEx", "Marketing",
+                "Salaries", "Rent", "Software", "Meals", "Travel",
+                "Personal", "Transfer", "Utilities", "Insurance", "Taxes"
+            ]
+            cursor.executemany("INSERT INTO categories (name) VALUES (?)", [(c,) for c in defaults])
+
+def _numeric_column(df, name):
+    """
+    Return a column as a float array with missing/unparseable values as 0.
+    """
+    if name not in df:
+        return np.zeros(len(df))
+    return pd.to_numeric(df[name], errors='coerce').fillna(0).to_numpy(dtype=float)
 
 def save_transactions(df, filename):
     """
@@ -80,73 +226,95 @@ def save_transactions(df, filename):
     if df.empty:
         return 0
 
-    conn = get_connection()
-    cursor = conn.cursor()
-
-    saved_count = 0
-    records_to_insert = []
-
-    for _, row in df.iterrows():
-        date = row.get('date', '')
-        desc = row.get('description', '')
-        source = row.get('source_file', filename)
-
-        # Calculate amount
-        withdrawal = pd.to_numeric(row.get('withdrawal', 0), errors='coerce')
-        if pd.isna(withdrawal): withdrawal = 0
-
-        deposit = pd.to_numeric(row.get('deposit', 0), errors='coerce')
-        if pd.isna(deposit): deposit = 0
-
-        amount = deposit - withdrawal
-
-        # Category default
-        category = 'Uncategorized'
-        project_name = None # Default project name
-
-        records_to_insert.append((date, desc, amount, category, source, project_name))
-
-    # Use INSERT OR IGNORE to handle duplicates
-    cursor.executemany('''
-        INSERT OR IGNORE INTO transactions (date, description, amount, category, source_file, project_name)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', records_to_insert)
-
-    saved_count = cursor.rowcount
-
-    conn.commit()
-    conn.close()
+    # Compute every column once over the whole frame
+    n = len(df)
+    withdrawal = _numeric_column(df, 'withdrawal')
+    deposit = _numeric_column(df, 'deposit')
+    amount = deposit - withdrawal
+
+    dates = df['date'].fillna('').tolist() if 'date' in df else [''] * n
+    descriptions = df['description'].fillna('').tolist() if 'description' in df else [''] * n
+    sources = df['source_file'].fillna(filename).tolist() if 'source_file' in df else [filename] * n
+
+    records_to_insert = list(zip(
+        dates, descriptions, amount.tolist(), ['Uncategorized'] * n, sources, [None] * n
+    ))
+
+    with transaction() as cursor:
+        # Stage the batch in an unindexed temp table, collapse in-batch duplicates there,
+        # then INSERT OR IGNORE only the distinct rows so each probes the UNIQUE index once
+        cursor.execute("DROP TABLE IF EXISTS temp.import_stage")
+        cursor.execute('''
+            CREATE TEMP TABLE import_stage (
+                date TEXT,
+                description TEXT,
+                amount REAL,
+                category TEXT,
+                source_file TEXT,
+                project_name TEXT
+            )
+        ''')
+        cursor.executemany('''
+            INSERT INTO import_stage (date, description, amount, category, source_file, project_name)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', records_to_insert)
+        cursor.execute('''
+            INSERT OR IGNORE INTO transactions (date, description, amount, category, source_file, project_name)
+            SELECT date, description, amount, category, source_file, project_name
+            FROM import_stage
+            GROUP BY date, description, amount, category, source_file, project_name
+            ORDER BY MIN(rowid)
+        ''')
+        saved_count = cursor.rowcount
+        cursor.execute("DROP TABLE import_stage")
+
+    # Refresh planner statistics so lookups keep using the UNIQUE and partial indexes.
+    # optimize only re-analyzes when the table has changed enough, and analysis_limit
+    # bounds the rows it samples, so imports don't slow down as the table grows
+    if saved_count:
+        with _conn_lock:
+            get_connection().execute("PRAGMA optimize")
 
     return saved_count
 
+def _read_transactions(where=""):
+    """
+    Select the transaction columns and return a DataFrame with fixed dtypes,
+    so an empty result has the same columns and types as a full one.
+    """
+    query = f"SELECT {', '.join(TRANSACTION_DTYPES)} FROM transactions {where}"
+    with _conn_lock:
+        return pd.read_sql_query(query, get_connection(), dtype=TRANSACTION_DTYPES)
+
 def get_all_transactions():
     """
     Return all transactions as a DataFrame.
     """
-    conn = get_connection()
-    df = pd.read_sql_query("SELECT * FROM transactions", conn)
-    conn.close()
-    return df
+    return _read_transactions()
 
 def get_uncategorized():
     """
     Return uncategorized transactions as a DataFrame.
     """
-    conn = get_connection()
-    df = pd.read_sql_query("SELECT * FROM transactions WHERE category = 'Uncategorized'", conn)
-    conn.close()
-    return df
+    return _read_transactions("WHERE category = 'Uncategorized'")
+
+@st.cache_data(max_entries=4)
+def get_amount_by_category(version):
+    """
+    Return the total amount per category as a dict.
+    Reads the trigger-maintained category_totals table, so no transactions are scanned.
+    """
+    with read_cursor() as cursor:
+        cursor.execute("SELECT category, sum_amount FROM category_totals ORDER BY category")
+        return dict(cursor.fetchall())
 
 def update_transaction(id, field, value):
     """
     Update a specific field for a transaction.
     """
-    conn = get_connection()
-    cursor = conn.cursor()
     query = f"UPDATE transactions SET {field} = ? WHERE id = ?"
-    cursor.execute(query, (value, id))
-    conn.commit()
-    conn.close()
+    with transaction() as cursor:
+        cursor.execute(query, (value, id))
 
 def update_transactions_batch(updates):
     """
@@ -154,19 +322,18 @@ def update_transactions_batch(updates):
     updates: list of dictionaries with 'id' and fields to update.
     Example: [{'id': 1, 'category': 'Meals'}, {'id': 2, 'project_name': 'Project A'}]
     """
-    conn = get_connection()
-    cursor = conn.cursor()
-
+    # Group updates that touch the same columns so each shape is prepared once
+    groups = defaultdict(list)
     for update in updates:
-        id = update.pop('id')
-        set_clause = ", ".join([f"{k} = ?" for k in update.keys()])
-        values = list(update.values())
-        values.append(id)
+        columns = tuple(sorted(k for k in update if k != 'id'))
+        groups[columns].append(tuple(update[k] for k in columns) + (update['id'],))
 
-        cursor.execute(f"UPDATE transactions SET {set_clause} WHERE id = ?", values)
-
-    conn.commit()
-    conn.close()
+    with transaction() as cursor:
+        for columns, rows in groups.items():
+            if not columns:
+                continue
+            set_clause = ", ".join([f"{k} = ?" for k in columns])
+            cursor.executemany(f"UPDATE transactions SET {set_clause} WHERE id = ?", rows)
 
 def delete_transactions(ids):
     """
@@ -174,61 +341,74 @@ def delete_transactions(ids):
     """
     if not ids:
         return
-    conn = get_connection()
-    cursor = conn.cursor()
-    placeholders = ', '.join(['?'] * len(ids))
-    cursor.execute(f"DELETE FROM transactions WHERE id IN ({placeholders})", ids)
-    conn.commit()
-    conn.close()
+    # One IN statement per chunk keeps each call under SQLite's bound-parameter limit,
+    # and a single transaction means one commit for the whole selection
+    with transaction() as cursor:
+        for start in range(0, len(ids), DELETE_CHUNK_SIZE):
+            chunk = ids[start:start + DELETE_CHUNK_SIZE]
+            placeholders = ', '.join(['?'] * len(chunk))
+            cursor.execute(f"DELETE FROM transactions WHERE id IN ({placeholders})", chunk)
 
 # --- Settings Management ---
 
-def get_starting_balance():
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT value FROM settings WHERE key = 'starting_balance'")
-    row = cursor.fetchone()
-    conn.close()
+@st.cache_data(max_entries=4)
+def get_starting_balance(version):
+    with read_cursor() as cursor:
+        cursor.execute("SELECT value FROM settings WHERE key = 'starting_balance'")
+        row = cursor.fetchone()
     if row:
         return float(row[0])
     return 0.0
 
 def set_starting_balance(amount):
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('starting_balance', ?)", (str(amount),))
-    conn.commit()
-    conn.close()
+    with transaction() as cursor:
+        cursor.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('starting_balance', ?)", (str(amount),))
+
+def get_pending_batch_id():
+    with read_cursor() as cursor:
+        cursor.execute("SELECT value FROM settings WHERE key = 'pending_batch_id'")
+        row = cursor.fetchone()
+    if row:
+        return row[0]
+    return None
+
+def set_pending_batch_id(batch_id):
+    """
+    Remember the Azure OpenAI batch job awaiting results. Pass None to clear it.
+    """
+    with transaction() as cursor:
+        if batch_id is None:
+            cursor.execute("DELETE FROM settings WHERE key = 'pending_batch_id'")
+        else:
+            cursor.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('pending_batch_id', ?)", (batch_id,))
 
 # --- Category Management ---
 
-def get_categories():
+@st.cache_data(max_entries=4)
+def get_categories(version):
     """
     Return categories as a list of names.
+    Cached per database version (see get_db_version).
     """
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT name FROM categories ORDER BY name")
-    categories = [row[0] for row in cursor.fetchall()]
-    conn.close()
+    with read_cursor() as cursor:
+        cursor.execute("SELECT name FROM categories ORDER BY name")
+        categories = [row[0] for row in cursor.fetchall()]
     return categories
 
-def get_categories_df():
+@st.cache_data(max_entries=4)
+def get_categories_df(version):
     """
     Return categories as a DataFrame with id and name.
+    Cached per database version (see get_db_version).
     """
-    conn = get_connection()
-    df = pd.read_sql_query("SELECT * FROM categories ORDER BY name", conn)
-    conn.close()
+    with _conn_lock:
+        df = pd.read_sql_query("SELECT * FROM categories ORDER BY name", get_connection())
     return df
 
 def add_category(name):
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO categories (name) VALUES (?)", (name,))
-        conn.commit()
-        conn.close()
+        with transaction() as cursor:
+            cursor.execute("INSERT INTO categories (name) VALUES (?)", (name,))
         return True
     except sqlite3.IntegrityError:
         return False
@@ -237,104 +417,165 @@ def update_category_name(id, new_name):
     """
     Update a category name and propagate the change to transactions and rules.
     """
-    conn = get_connection()
-    cursor = conn.cursor()
-
     try:
-        # Get old name
-        cursor.execute("SELECT name FROM categories WHERE id = ?", (id,))
-        row = cursor.fetchone()
-        if not row:
-            return False
-        old_name = row[0]
+        with transaction() as cursor:
+            # Get old name
+            cursor.execute("SELECT name FROM categories WHERE id = ?", (id,))
+            row = cursor.fetchone()
+            if not row:
+                return False
+            old_name = row[0]
 
-        # Update category name
-        cursor.execute("UPDATE categories SET name = ? WHERE id = ?", (new_name, id))
+            # Update category name
+            cursor.execute("UPDATE categories SET name = ? WHERE id = ?", (new_name, id))
 
-        # Propagate to transactions
-        cursor.execute("UPDATE transactions SET category = ? WHERE category = ?", (new_name, old_name))
+            # Propagate to transactions
+            cursor.execute("UPDATE transactions SET category = ? WHERE category = ?", (new_name, old_name))
 
-        # Propagate to rules
-        cursor.execute("UPDATE rules SET category_name = ? WHERE category_name = ?", (new_name, old_name))
+            # Propagate to rules
+            cursor.execute("UPDATE rules SET category_name = ? WHERE category_name = ?", (new_name, old_name))
 
-        conn.commit()
         return True
     except sqlite3.IntegrityError:
         # Likely new name already exists
         return False
-    finally:
-        conn.close()
+
+def update_category_names_batch(updates):
+    """
+    Rename several categories at once and propagate the changes to transactions and rules.
+    updates: list of (id, new_name) tuples.
+    Swaps and chains (A -> B, B -> C) are fine as long as the final names are unique.
+    Returns False, and changes nothing, if a new name collides with another category.
+    """
+    if not updates:
+        return True
+    try:
+        with transaction() as cursor:
+            # Stage old -> new names so every rename is applied in one pass per table
+            # and renamed transactions and rules don't cascade through a chain
+            cursor.execute("DROP TABLE IF EXISTS temp.category_renames")
+            cursor.execute('''
+                CREATE TEMP TABLE category_renames (
+                    id INTEGER PRIMARY KEY,
+                    old_name TEXT,
+                    new_name TEXT
+                )
+            ''')
+            cursor.executemany("INSERT INTO temp.category_renames (id, new_name) VALUES (?, ?)", updates)
+            cursor.execute('''
+                UPDATE temp.category_renames SET old_name = c.name
+                FROM categories AS c WHERE c.id = category_renames.id
+            ''')
+
+            # UNIQUE is checked row by row, so first move every renamed category to a
+            # placeholder name; only collisions among the final names then fail
+            cursor.execute('''
+                UPDATE categories SET name = char(0) || categories.id
+                FROM temp.category_renames AS r WHERE categories.id = r.id
+            ''')
+            cursor.execute('''
+                UPDATE categories SET name = r.new_name
+                FROM temp.category_renames AS r WHERE categories.id = r.id
+            ''')
+            cursor.execute('''
+                UPDATE transactions SET category = r.new_name
+                FROM temp.category_renames AS r WHERE transactions.category = r.old_name
+            ''')
+            cursor.execute('''
+                UPDATE rules SET category_name = r.new_name
+                FROM temp.category_renames AS r WHERE rules.category_name = r.old_name
+            ''')
+            cursor.execute("DROP TABLE temp.category_renames")
+
+        return True
+    except sqlite3.IntegrityError:
+        # A new name collides with an existing category
+        return False
 
 def delete_category(name):
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM categories WHERE name = ?", (name,))
-    conn.commit()
-    conn.close()
+    with transaction() as cursor:
+        cursor.execute("DELETE FROM categories WHERE name = ?", (name,))
 
 # --- Rule Management ---
 
-def get_rules():
-    conn = get_connection()
-    df = pd.read_sql_query("SELECT * FROM rules ORDER BY keyword", conn)
-    conn.close()
+@st.cache_data(max_entries=4)
+def get_rules(version):
+    with _conn_lock:
+        df = pd.read_sql_query("SELECT * FROM rules ORDER BY keyword", get_connection())
     return df
 
 def add_rule(keyword, category_name):
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO rules (keyword, category_name) VALUES (?, ?)", (keyword, category_name))
-        conn.commit()
-        conn.close()
+        with transaction() as cursor:
+            cursor.execute("INSERT INTO rules (keyword, category_name) VALUES (?, ?)", (keyword, category_name))
         return True
     except sqlite3.IntegrityError:
         return False
 
 def delete_rule(id):
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM rules WHERE id = ?", (id,))
-    conn.commit()
-    conn.close()
+    with transaction() as cursor:
+        cursor.execute("DELETE FROM rules WHERE id = ?", (id,))
 
 # --- Auto-Categorization Logic ---
 
+@st.cache_resource(max_entries=4)
+def _build_rule_automaton(version):
+    """
+    Compile all rule keywords (lowercased) into one Aho-Corasick automaton.
+    Keyed on the database version, so adding, deleting or renaming rules rebuilds it.
+    """
+    with read_cursor() as cursor:
+        cursor.execute("SELECT id, keyword, category_name FROM rules ORDER BY id")
+        rules = cursor.fetchall()
+
+    automaton = ahocorasick.Automaton()
+    for id, keyword, category in rules:
+        # Keep the oldest rule when keywords differ only by case
+        if keyword and keyword.lower() not in automaton:
+            automaton.add_word(keyword.lower(), (id, keyword, category))
+    automaton.make_automaton()
+    return automaton
+
+def get_rule_automaton():
+    return _build_rule_automaton(get_db_version())
+
+def match_rule(automaton, description):
+    """
+    Return (keyword, category) of the oldest rule whose keyword is in the description, or None.
+    """
+    if not description or automaton.kind != ahocorasick.AHOCORASICK:
+        return None
+    # Hits come back in the order they end in the text, so pick the lowest rule id explicitly
+    match = min((hit for _, hit in automaton.iter(description.lower())), default=None)
+    return match[1:] if match else None
+
 def predict_category(description):
     """
     Predict category based on:
     1. Exact keyword match in rules.
     2. Historical match (most frequent category for this exact description).
     """
-    conn = get_connection()
-    cursor = conn.cursor()
     description = description.strip()
 
     # 1. Check Rules
-    # We need to check if any keyword is IN the description.
-    # Since SQL LIKE is usually 'keyword LIKE description', we do it in python for flexibility or reverse LIKE.
-    # For simple keyword matching:
-    cursor.execute("SELECT keyword, category_name FROM rules")
-    rules = cursor.fetchall()
-
-    for keyword, category in rules:
-        if keyword.lower() in description.lower():
-            conn.close()
-            return category, "Rule: " + keyword
+    # A single pass over the description finds any rule keyword it contains.
+    match = match_rule(get_rule_automaton(), description)
+    if match:
+        keyword, category = match
+        return category, "Rule: " + keyword
 
     # 2. Check History
     # Find most used category for this description
-    cursor.execute('''
-        SELECT category, COUNT(*) as cnt
-        FROM transactions
-        WHERE description = ? AND category != 'Uncategorized'
-        GROUP BY category
-        ORDER BY cnt DESC
-        LIMIT 1
-    ''', (description,))
-
-    row = cursor.fetchone()
-    conn.close()
+    with read_cursor() as cursor:
+        cursor.execute('''
+            SELECT category, COUNT(*) as cnt
+            FROM transactions
+            WHERE description = ? AND category != 'Uncategorized'
+            GROUP BY category
+            ORDER BY cnt DESC
+            LIMIT 1
+        ''', (description,))
+        row = cursor.fetchone()
 
     if row:
         return row[0], "History"
@@ -343,28 +584,55 @@ def predict_category(description):
 
 def apply_auto_categorization():
     """
-    Iterate over all 'Uncategorized' transactions and try to predict category.
+    Categorize all 'Uncategorized' transactions in two set-based UPDATEs,
+    using the same precedence as predict_category: rules first, then history.
     Returns count of updated rows.
     """
-    conn = get_connection()
-    cursor = conn.cursor()
-
-    # Get uncategorized
-    cursor.execute("SELECT id, description FROM transactions WHERE category = 'Uncategorized'")
-    rows = cursor.fetchall()
-
-    updated_count = 0
-    updates = []
-
-    for id, desc in rows:
-        category, source = predict_category(desc)
-        if category:
-            updates.append((category, id))
-            updated_count += 1
-
-    if updates:
-        cursor.executemany("UPDATE transactions SET category = ? WHERE id = ?", updates)
-        conn.commit()
+    automaton = get_rule_automaton()
+
+    def rule_category(description):
+        match = match_rule(automaton, description)
+        return match[1] if match else None
+
+    with transaction() as cursor:
+        cursor.connection.create_function('match_rule', 1, rule_category, deterministic=True)
+
+        # 1. Rules: matched inline by the compiled keyword automaton.
+        # Materializing the matches runs the automaton once per uncategorized row
+        # instead of once for the filter and again for the new value
+        cursor.execute('''
+            WITH matched AS MATERIALIZED (
+                SELECT id, match_rule(description) AS category
+                FROM transactions
+                WHERE category = 'Uncategorized'
+            )
+            UPDATE transactions
+            SET category = matched.category
+            FROM matched
+            WHERE transactions.id = matched.id
+              AND matched.category IS NOT NULL
+        ''')
+        # rowcount isn't reported for statements starting with WITH
+        updated_count = cursor.execute("SELECT changes()").fetchone()[0]
+
+        # 2. History: most used category for the same description
+        cursor.execute('''
+            UPDATE transactions
+            SET category = top.category
+            FROM (
+                SELECT description, category,
+                       row_number() OVER (PARTITION BY description ORDER BY cnt DESC) AS r
+                FROM (
+                    SELECT description, category, COUNT(*) AS cnt
+                    FROM transactions
+                    WHERE category != 'Uncategorized'
+                    GROUP BY description, category
+                )
+            ) AS top
+            WHERE transactions.category = 'Uncategorized'
+              AND top.r = 1
+              AND top.description = trim(transactions.description)
+        ''')
+        updated_count += cursor.rowcount
 
-    conn.close()
     return updated_count
@@ -1,26 +1,55 @@
 import streamlit as st
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+from pyarrow import csv as pacsv
+import io
+import math
 import database
 
+# Columns the user can edit and save back to the database
+EDITABLE_COLUMNS = ['category', 'date', 'amount', 'project_name']
+
+# Rows sent to the editor per page
+PAGE_SIZE = 500
+
+def to_csv_bytes(df):
+    """
+    Serialize a DataFrame to CSV bytes using Arrow's multithreaded C++ writer.
+    """
+    buf = io.BytesIO()
+    pacsv.write_csv(pa.Table.from_pandas(df, preserve_index=False), buf)
+    return buf.getvalue()
+
+@st.cache_resource(max_entries=4)
+def _load_tx(version, which):
+    """
+    Load transactions once per database version and share the frame across reruns.
+    Callers must .copy() the result before modifying it.
+    """
+    return database.get_uncategorized() if which == 'u' else database.get_all_transactions()
+
 st.set_page_config(page_title="Transaction Classifier", layout="wide")
 st.title("Transaction Classifier")
 
 # 1. Load Data & Settings
+# Cached reads below are keyed on this and refresh only after a write
+version = database.get_db_version()
+
 # Starting Balance
-current_balance = database.get_starting_balance()
-new_balance = st.number_input("Starting Balance", value=current_balance, step=100.0)
-if new_balance != current_balance:
-    database.set_starting_balance(new_balance)
-    st.success("Starting balance updated!")
-    st.rerun()
+current_balance = database.get_starting_balance(version)
+with st.form("starting_balance_form"):
+    new_balance = st.number_input("Starting Balance", value=current_balance, step=100.0)
+    if st.form_submit_button("Update Balance") and new_balance != current_balance:
+        database.set_starting_balance(new_balance)
+        st.success("Starting balance updated!")
+        st.rerun()
 
 # Filter option
 filter_option = st.radio("Show:", ["Uncategorized", "All Transactions"], horizontal=True)
 
-if filter_option == "Uncategorized":
-    df = database.get_uncategorized()
-else:
-    df = database.get_all_transactions()
+# Copy so the cached frame isn't modified by this run
+df = _load_tx(version, 'u' if filter_option == "Uncategorized" else 'a').copy()
 
 if df.empty:
     st.info("No transactions found in the database.")
@@ -39,7 +68,7 @@ else:
             st.info("No new auto-categorizations found.")
 
     # Define categories from DB
-    categories = database.get_categories()
+    categories = database.get_categories(version)
 
     # Add 'Select' column for deletion
     df['Select'] = False
@@ -47,126 +76,152 @@ else:
     # Ensure project_name exists in df (if new column added to DB but not yet in loaded DF for some reason, though read_sql should handle it)
     if 'project_name' not in df.columns:
         df['project_name'] = ""
-
-    # Use data_editor
-    # We need to handle updates.
-    # st.data_editor returns the edited dataframe.
-    edited_df = st.data_editor(
-        df,
-        column_config={
-            "Select": st.column_config.CheckboxColumn("Select", help="Select to delete"),
-            "id": st.column_config.NumberColumn("ID", disabled=True),
-            "date": st.column_config.TextColumn("Date", required=True),
-            "description": st.column_config.TextColumn("Description", disabled=True),
-            "amount": st.column_config.NumberColumn("Amount", required=True),
-            "source_file": st.column_config.TextColumn("Source File", disabled=True),
-            "project_name": st.column_config.TextColumn("Project Name"),
-            "category": st.column_config.SelectboxColumn(
-                "Category",
-                help="Select the category for this transaction",
-                width="medium",
-                options=categories,
-                required=True,
-            )
-        },
-        column_order=["id", "Select", "date", "description", "amount", "category", "project_name", "source_file"],
-        hide_index=True,
-        num_rows="fixed", # Don't allow adding/deleting rows here, only editing
-        key="data_editor"
-    )
-
-    # Actions
-    st.subheader("Actions")
-    col_actions1, col_actions2, col_actions3 = st.columns([1, 1, 2])
+    # Normalize missing project names once so diffs compare plain strings
+    df['project_name'] = df['project_name'].fillna("")
+
+    # Only one page of rows is serialized to the editor per rerun
+    page_count = math.ceil(len(df) / PAGE_SIZE)
+    page = st.number_input("Page", min_value=1, max_value=page_count, value=1, step=1) if page_count > 1 else 1
+    start, end = (page - 1) * PAGE_SIZE, page * PAGE_SIZE
+    page_df = df.iloc[start:end].reset_index(drop=True)
+    editor_key = f"data_editor_{filter_option}_{page}"
+    shown_key = f"{editor_key}_rows"
+
+    # Edited cells are tracked by row position. If another session changed which rows
+    # are on this page, keep showing the rows the edits were made on so none are lost
+    shown_df = st.session_state.get(shown_key)
+    pending = st.session_state.get(editor_key, {}).get("edited_rows")
+    if pending and shown_df is not None and not shown_df['id'].equals(page_df['id']):
+        page_df = shown_df
+        st.warning("Transactions on this page were changed in another session. "
+                   "Your unsaved edits are kept on the rows you made them on.")
+        st.button("Discard Edits", on_click=lambda: st.session_state.pop(editor_key, None))
+    st.session_state[shown_key] = page_df
+
+    # Edits, selections and the target year are only sent when one of the buttons
+    # below is pressed, instead of rerunning the page on every cell change
+    with st.form("editor_form"):
+        # Use data_editor
+        # We need to handle updates.
+        # st.data_editor returns the edited dataframe.
+        edited_df = st.data_editor(
+            page_df,
+            column_config={
+                "Select": st.column_config.CheckboxColumn("Select", help="Select to delete"),
+                "id": st.column_config.NumberColumn("ID", disabled=True),
+                "date": st.column_config.TextColumn("Date", required=True),
+                "description": st.column_config.TextColumn("Description", disabled=True),
+                "amount": st.column_config.NumberColumn("Amount", required=True),
+                "source_file": st.column_config.TextColumn("Source File", disabled=True),
+                "project_name": st.column_config.TextColumn("Project Name"),
+                "category": st.column_config.SelectboxColumn(
+                    "Category",
+                    help="Select the category for this transaction",
+                    width="medium",
+                    options=categories,
+                    required=True,
+                )
+            },
+            column_order=["id", "Select", "date", "description", "amount", "category", "project_name", "source_file"],
+            hide_index=True,
+            num_rows="fixed", # Don't allow adding/deleting rows here, only editing
+            key=editor_key
+        )
+
+        # Actions
+        st.subheader("Actions")
+        col_actions1, col_actions2, col_actions3 = st.columns([1, 1, 2])
+        save_clicked = col_actions1.form_submit_button("Save Changes")
+        delete_clicked = col_actions2.form_submit_button("Delete Selected")
+        c1, c2 = col_actions3.columns([1, 1])
+        target_year = c1.number_input("Target Year", min_value=2000, max_value=2100, value=2024, step=1)
+        year_clicked = c2.form_submit_button("Apply Year to Selected")
 
     # 3. Save Changes
-    with col_actions1:
-        if st.button("Save Changes"):
-            # Detect changes
-            # We iterate and check for changes in category, date, project_name, amount
-
-            updates = []
-            for index, row in edited_df.iterrows():
-                original_row = df.iloc[index]
-
-                # Check for changes
-                row_updates = {}
-                if row['category'] != original_row['category']:
-                    row_updates['category'] = row['category']
-                if row['date'] != original_row['date']:
-                    row_updates['date'] = row['date']
-                if row['amount'] != original_row['amount']:
-                    row_updates['amount'] = row['amount']
-                if row['project_name'] != original_row['project_name']:
-                    # Handle NaN/None vs empty string
-                    p_new = row['project_name'] if pd.notna(row['project_name']) else ""
-                    p_old = original_row['project_name'] if pd.notna(original_row['project_name']) else ""
-                    if p_new != p_old:
-                        row_updates['project_name'] = p_new
-
-                if row_updates:
-                    row_updates['id'] = row['id']
-                    updates.append(row_updates)
-
-            if updates:
-                database.update_transactions_batch(updates)
-                st.success(f"Updated {len(updates)} transactions.")
-                st.rerun()
-            else:
-                st.info("No changes detected.")
+    if save_clicked:
+        # Streamlit tracks the rows the user touched as {row position: {column: new value}}
+        positions = np.array(sorted(int(i) for i in st.session_state[editor_key].get("edited_rows", {})), dtype=int)
+        new_rows = edited_df.iloc[positions]
+        old_rows = page_df.iloc[positions]
+        ids = new_rows['id'].to_numpy()
+
+        # Compare the touched rows with one vectorized mask per column,
+        # so edits that were reverted don't produce updates
+        changes = {}
+        for col in EDITABLE_COLUMNS:
+            new_values = new_rows[col]
+            old_values = old_rows[col]
+            if col == 'project_name':
+                # A cleared cell comes back from the editor as None
+                new_values = new_values.fillna("")
+
+            # Missing values become None on both sides, so missing vs missing is not a change
+            new_array = new_values.to_numpy(dtype=object, na_value=None)
+            old_array = old_values.to_numpy(dtype=object, na_value=None)
+            changed = new_array != old_array
+            for id, value in zip(ids[changed].tolist(), new_array[changed].tolist()):
+                changes.setdefault(id, {'id': id})[col] = value
+
+        updates = list(changes.values())
+
+        if updates:
+            database.update_transactions_batch(updates)
+            st.success(f"Updated {len(updates)} transactions.")
+            del st.session_state[editor_key]
+            st.rerun()
+        else:
+            st.info("No changes detected.")
 
     # 4. Delete Selected
-    with col_actions2:
-        if st.button("Delete Selected"):
-            selected_rows = edited_df[edited_df['Select']]
-            if not selected_rows.empty:
-                ids_to_delete = selected_rows['id'].tolist()
-                database.delete_transactions(ids_to_delete)
-                st.success(f"Deleted {len(ids_to_delete)} transactions.")
-                st.rerun()
-            else:
-                st.warning("No transactions selected for deletion.")
+    if delete_clicked:
+        selected_rows = edited_df[edited_df['Select']]
+        if not selected_rows.empty:
+            ids_to_delete = selected_rows['id'].tolist()
+            database.delete_transactions(ids_to_delete)
+            st.success(f"Deleted {len(ids_to_delete)} transactions.")
+            del st.session_state[editor_key]
+            st.rerun()
+        else:
+            st.warning("No transactions selected for deletion.")
 
     # 5. Batch Update Year
-    with col_actions3:
-        with st.form("batch_year_form"):
-            st.write("Batch Update Year")
-            c1, c2 = st.columns([1, 1])
-            target_year = c1.number_input("Target Year", min_value=2000, max_value=2100, value=2024, step=1)
-            if c2.form_submit_button("Apply to Selected"):
-                selected_rows = edited_df[edited_df['Select']]
-                if not selected_rows.empty:
-                    updates = []
-                    for index, row in selected_rows.iterrows():
-                        try:
-                            # Parse date
-                            # Assuming YYYY-MM-DD or similar standard format
-                            current_date = pd.to_datetime(row['date'])
-                            # Update year
-                            new_date = current_date.replace(year=target_year)
-                            # Format back to string (ISO format)
-                            new_date_str = new_date.strftime('%Y-%m-%d')
-
-                            updates.append({
-                                'id': row['id'],
-                                'date': new_date_str
-                            })
-                        except Exception as e:
-                            st.error(f"Error parsing date for ID {row['id']}: {e}")
-
-                    if updates:
-                        database.update_transactions_batch(updates)
-                        st.success(f"Updated year to {target_year} for {len(updates)} transactions.")
-                        st.rerun()
-                else:
-                    st.warning("No transactions selected.")
+    if year_clicked:
+        selected_rows = edited_df[edited_df['Select']]
+        if not selected_rows.empty:
+            # Parse the whole selection at once; ISO dates take the fast path
+            dates = pd.to_datetime(selected_rows['date'], format='%Y-%m-%d', errors='coerce')
+            other = dates.isna() & selected_rows['date'].notna()
+            if other.any():
+                dates[other] = pd.to_datetime(selected_rows.loc[other, 'date'], format='mixed', errors='coerce')
+
+            # Swap in the target year, then re-parse to reject dates like Feb 29 in a non-leap year
+            new_dates = dates.dt.strftime(f'{target_year}-%m-%d')
+            valid = pd.to_datetime(new_dates, format='%Y-%m-%d', errors='coerce').notna()
+
+            updates = [
+                {'id': id, 'date': date}
+                for id, date in zip(selected_rows.loc[valid, 'id'].tolist(), new_dates[valid].tolist())
+            ]
+
+            if not valid.all():
+                failed_ids = selected_rows.loc[~valid, 'id'].tolist()
+                st.error(f"Could not update the date for IDs: {', '.join(map(str, failed_ids))}")
+
+            if updates:
+                database.update_transactions_batch(updates)
+                st.success(f"Updated year to {target_year} for {len(updates)} transactions.")
+                del st.session_state[editor_key]
+                st.rerun()
+        else:
+            st.warning("No transactions selected.")
 
     # 5. Export
     st.subheader("Export Categorized Data")
 
     # Summary stats
     if 'amount' in edited_df.columns:
-        total_amount = edited_df['amount'].sum()
+        # Whole view, with the current page's unsaved edits in place of its loaded rows
+        total_amount = df['amount'].sum() - df['amount'].iloc[start:end].sum() + edited_df['amount'].sum()
         final_balance = new_balance + total_amount
 
         col_metric1, col_metric2, col_metric3 = st.columns(3)
@@ -175,13 +230,23 @@ else:
         col_metric3.metric("Final Balance", f"{final_balance:.2f}")
 
         # Group by Category
-        st.write("Summary by Category:")
-        st.dataframe(edited_df.groupby('category')['amount'].sum())
-
-    csv = edited_df.to_csv(index=False).encode('utf-8')
-    st.download_button(
-        label="Download Categorized CSV",
-        data=csv,
-        file_name="categorized_transactions.csv",
-        mime="text/csv",
-    )
+        st.write("Summary by Category (saved transactions):")
+        by_category = database.get_amount_by_category(version)
+        st.dataframe(pd.Series(by_category, name='amount', dtype=float).rename_axis('category'))
+
+    # Only serialize the table once the user asks for it, not on every rerun
+    if not st.session_state.get('want_csv'):
+        if st.button("Prepare CSV Export"):
+            st.session_state['want_csv'] = True
+            st.rerun()
+    else:
+        # Splice the current page's unsaved edits into the whole view
+        view_df = pd.concat([df.iloc[:start], edited_df, df.iloc[end:]], ignore_index=True)
+        csv = to_csv_bytes(view_df)
+        st.download_button(
+            label="Download Categorized CSV",
+            data=csv,
+            file_name="categorized_transactions.csv",
+            mime="text/csv",
+            on_click=lambda: st.session_state.pop('want_csv', None),
+        )
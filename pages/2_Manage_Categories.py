@@ -8,6 +8,9 @@ st.title("Manage Categories & Rules")
 # Initialize DB to ensure tables exist (in case this page is hit first)
 database.init_db()
 
+# Cached reads below are keyed on this and refresh only after a write
+version = database.get_db_version()
+
 tab1, tab2 = st.tabs(["Categories", "Rules"])
 
 with tab1:
@@ -28,7 +31,7 @@ with tab1:
     st.subheader("Existing Categories")
     st.write("You can rename categories here. Changes will update all existing transactions.")
 
-    categories_df = database.get_categories_df()
+    categories_df = database.get_categories_df(version)
 
     if not categories_df.empty:
         edited_categories = st.data_editor(
@@ -44,36 +47,31 @@ with tab1:
 
         # Save Changes
         if st.button("Save Category Changes"):
-            updates = []
-            for index, row in edited_df.iterrows() if 'edited_df' in locals() else edited_categories.iterrows():
-                original_row = categories_df.iloc[index]
-                if row['name'] != original_row['name']:
-                    updates.append((row['id'], row['name']))
-
-            success_count = 0
-            for id, new_name in updates:
-                if database.update_category_name(id, new_name):
-                    success_count += 1
-                else:
-                    st.error(f"Failed to update category ID {id} to '{new_name}'. Name might already exist.")
-
-            if success_count > 0:
-                st.success(f"Updated {success_count} categories.")
-                st.rerun()
-            elif not updates:
+            # Rows are in the same order as loaded, so compare the name columns directly
+            changed = edited_categories['name'].to_numpy() != categories_df['name'].to_numpy()
+            updates = list(zip(
+                edited_categories.loc[changed, 'id'].tolist(),
+                edited_categories.loc[changed, 'name'].tolist()
+            ))
+
+            if not updates:
                 st.info("No changes detected.")
+            elif database.update_category_names_batch(updates):
+                st.success(f"Updated {len(updates)} categories.")
+                st.rerun()
+            else:
+                st.error("Failed to update categories. A new name might already exist.")
 
         # Delete Section (Separate to avoid accidental deletes in editor)
         st.divider()
         st.subheader("Delete Category")
-        cat_to_delete = st.selectbox("Select Category to Delete", options=categories_df['name'].tolist())
-        if st.button("Delete Category"):
-            if cat_to_delete == "Uncategorized":
-                st.error("Cannot delete 'Uncategorized'.")
-            else:
-                database.delete_category(cat_to_delete)
-                st.success(f"Deleted category: {cat_to_delete}")
-                st.rerun()
+        # 'Uncategorized' is the default for imported transactions, so it isn't offered
+        deletable = [name for name in categories_df['name'].tolist() if name != "Uncategorized"]
+        cat_to_delete = st.selectbox("Select Category to Delete", options=deletable)
+        if st.button("Delete Category", disabled=not deletable):
+            database.delete_category(cat_to_delete)
+            st.success(f"Deleted category: {cat_to_delete}")
+            st.rerun()
 
     else:
         st.info("No categories found.")
@@ -86,7 +84,7 @@ with tab2:
     with st.form("add_rule_form", clear_on_submit=True):
         col1, col2 = st.columns(2)
         keyword = col1.text_input("Keyword (e.g., 'Uber')")
-        category = col2.selectbox("Category", options=database.get_categories())
+        category = col2.selectbox("Category", options=database.get_categories(version))
 
         submitted = st.form_submit_button("Add Rule")
         if submitted and keyword and category:
@@ -97,7 +95,7 @@ with tab2:
                 st.error("Rule for this keyword already exists.")
 
     # List Rules
-    rules_df = database.get_rules()
+    rules_df = database.get_rules(version)
     if not rules_df.empty:
         st.dataframe(rules_df, use_container_width=True)
 
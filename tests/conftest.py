@@ -0,0 +1,19 @@
+import pytest
+import streamlit as st
+
+import database
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """
+    An initialized database in a temporary directory, with Streamlit caches reset around it.
+    """
+    monkeypatch.chdir(tmp_path)
+    st.cache_resource.clear()
+    st.cache_data.clear()
+    database.init_db()
+    yield database
+    database.get_connection().close()
+    st.cache_resource.clear()
+    st.cache_data.clear()
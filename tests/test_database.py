@@ -0,0 +1,113 @@
+import sqlite3
+import threading
+
+import pandas as pd
+import pytest
+
+
+def add_transactions(db, descriptions):
+    df = pd.DataFrame({
+        'date': [f"2024-01-{i + 1:02d}" for i in range(len(descriptions))],
+        'description': descriptions,
+        'deposit': [1.0] * len(descriptions),
+    })
+    db.save_transactions(df, "statement.png")
+    return {row.description: row.id for row in db.get_all_transactions().itertuples()}
+
+
+def categories_by_id(db):
+    return dict(db.get_connection().execute("SELECT id, category FROM transactions").fetchall())
+
+
+def test_auto_categorization_rolls_back_rule_updates_when_history_step_fails(db):
+    ids = add_transactions(db, ["UBER trip", "Coffee", "Coffee "])
+    db.add_rule("UBER", "Travel")
+    db.update_transactions_batch([{'id': int(ids["Coffee"]), 'category': "Meals"}])
+
+    # Make step 2 (history) fail after step 1 (rules) has run
+    db.get_connection().execute('''
+        CREATE TEMP TRIGGER fail_history BEFORE UPDATE OF category ON transactions
+        WHEN NEW.category = 'Meals' AND OLD.category = 'Uncategorized'
+        BEGIN SELECT RAISE(ABORT, 'history step failed'); END
+    ''')
+    before = categories_by_id(db)
+    version = db.get_db_version()
+
+    with pytest.raises(sqlite3.Error):
+        db.apply_auto_categorization()
+
+    assert categories_by_id(db) == before
+    assert before[int(ids["UBER trip"])] == "Uncategorized"
+    assert db.get_db_version() == version
+
+
+def category_ids(db):
+    return dict(db.get_connection().execute("SELECT name, id FROM categories").fetchall())
+
+
+@pytest.mark.parametrize("reverse", [False, True])
+def test_rename_categories_in_a_chain(db, reverse):
+    ids = add_transactions(db, ["Supplier invoice", "Lunch"])
+    db.update_transactions_batch([
+        {'id': int(ids["Supplier invoice"]), 'category': "COGS"},
+        {'id': int(ids["Lunch"]), 'category': "Meals"},
+    ])
+    db.add_rule("Lunch", "Meals")
+    before = category_ids(db)
+    updates = [(before["COGS"], "Meals"), (before["Meals"], "Food")]
+
+    assert db.update_category_names_batch(updates[::-1] if reverse else updates)
+
+    after = category_ids(db)
+    assert after["Meals"] == before["COGS"]
+    assert after["Food"] == before["Meals"]
+    assert "COGS" not in after
+    categories = categories_by_id(db)
+    assert categories[int(ids["Supplier invoice"])] == "Meals"
+    assert categories[int(ids["Lunch"])] == "Food"
+    assert db.get_connection().execute("SELECT category_name FROM rules").fetchall() == [("Food",)]
+
+
+@pytest.mark.parametrize("reverse", [False, True])
+def test_swap_category_names(db, reverse):
+    before = category_ids(db)
+    updates = [(before["Rent"], "Travel"), (before["Travel"], "Rent")]
+
+    assert db.update_category_names_batch(updates[::-1] if reverse else updates)
+
+    after = category_ids(db)
+    assert after["Rent"] == before["Travel"]
+    assert after["Travel"] == before["Rent"]
+
+
+def test_rename_to_an_existing_name_changes_nothing(db):
+    before = category_ids(db)
+
+    assert not db.update_category_names_batch([(before["Rent"], "Travel"), (before["COGS"], "Food")])
+
+    assert category_ids(db) == before
+
+
+def test_readers_wait_for_an_open_transaction(db):
+    writing = threading.Event()
+    finish = threading.Event()
+    seen = []
+
+    def write():
+        with db.transaction() as cursor:
+            cursor.execute("INSERT INTO categories (name) VALUES ('Pending')")
+            writing.set()
+            finish.wait(5)
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    writing.wait(5)
+    reader = threading.Thread(target=lambda: seen.extend(db.get_categories(-1)))
+    reader.start()
+    reader.join(0.2)
+    assert reader.is_alive()
+
+    finish.set()
+    writer.join(5)
+    reader.join(5)
+    assert "Pending" in seen